@@ -1,72 +1,177 @@
-from typing import List
+import logging
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Tuple
 from urllib.parse import urlencode
 
 import cloudscraper
-from bs4 import BeautifulSoup
-from fuzzywuzzy import fuzz, process
+from lxml import etree, html
+from rapidfuzz import fuzz, process, utils
+
+logger = logging.getLogger(__name__)
+
+# Number of parsed search pages kept per scraper
+_TITLES_CACHE_SIZE = 256
+# Search pages list their results well within this; anything past it is not read
+_MAX_PAGE_BYTES = 2 * 1024 * 1024
+# Charset declared by a <meta charset> or <meta http-equiv> tag near the top of a page
+_META_CHARSET = re.compile(rb"""<meta[^>]+charset=["']?([\w.:-]+)""", re.IGNORECASE)
+# Non-empty alt text of every image on a results page, one per book cover
+_IMG_ALTS = etree.XPath("//img[@alt != '']/@alt")
+
+
+@lru_cache(maxsize=None)
+def _html_parser(encoding: str) -> html.HTMLParser:
+    # lxml locks a parser's context while it parses, so one parser per encoding is
+    # safe to share between threads; ids and whitespace are never looked at
+    return html.HTMLParser(encoding=encoding, collect_ids=False, remove_blank_text=True)
 
 
 class Scraper:
-    def __init__(self, titles: List[str], fuzz_thresh: int = 90):
+    def __init__(self, titles: List[str], fuzz_thresh: int = 90, workers: int = 8):
         self.titles = titles
-        self.scraper = cloudscraper.create_scraper()
         self.fuzz_thresh = fuzz_thresh
+        self.workers = workers
         self.base_url = ""
+        # Parsed result titles keyed by request URL, least recently used first
+        self._titles_cache: "OrderedDict[str, Dict[str, str]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._local = threading.local()
 
-    def search(self, query: str) -> str:
-        print("Searching for: {}".format(query))
+    @property
+    def scraper(self):
+        # Sessions aren't thread-safe, so every worker thread gets its own
+        if not hasattr(self._local, "scraper"):
+            self._local.scraper = cloudscraper.create_scraper()
+        return self._local.scraper
+
+    def search(self, query: str) -> Tuple[bytes, str]:
+        logger.debug("Searching for: %s", query)
         return self._search(query)
 
-    def find_title(self, title: str, titles: List[str]) -> bool:
+    def search_titles(self, query: str) -> Dict[str, str]:
+        """
+        Search for the query and parse the titles on the results page, reusing the
+        titles of an earlier search for the same URL.
+        """
+        url = self._url(query)
+        with self._cache_lock:
+            if url in self._titles_cache:
+                self._titles_cache.move_to_end(url)
+                return self._titles_cache[url]
+
+        titles = self.parse_titles(*self.search(query))
+
+        with self._cache_lock:
+            self._titles_cache[url] = titles
+            if len(self._titles_cache) > _TITLES_CACHE_SIZE:
+                self._titles_cache.popitem(last=False)
+        return titles
+
+    def find_title(self, title: str, titles: Dict[str, str]) -> Tuple[bool, str, int]:
         """
-        Fuzzy string match the title against a list of titles.
+        Fuzzy string match the title against a mapping of lowercased title to title.
         """
         if titles:
-            # extractBests?
-            choice, ratio = process.extractOne(
-                title.lower(),
-                list(map(lambda x: x.lower(), titles)),
+            # extractBests? default_process does the lowercasing for both sides
+            choice, score, _ = process.extractOne(
+                title,
+                titles,
                 scorer=fuzz.partial_ratio,
+                processor=utils.default_process,
             )
+            ratio = int(round(score))
             found = ratio >= self.fuzz_thresh
         else:
             choice = "N/A"
             found = False
             ratio = 0
-        print("'{}' was {}found".format(title, "" if found else "not "))
-        print("Closest match ({}%): {}".format(ratio, choice))
+        logger.debug("'%s' was %sfound", title, "" if found else "not ")
+        logger.debug("Closest match (%s%%): %s", ratio, choice)
         return found, choice, ratio
 
     def search_all_titles(self):
         found_titles = []
+        # Worker threads fetch and parse each page, so a raw page only lives until
+        # it is parsed; results come back in submission order, then get matched
+        # in shelf order
+        urls = {t: self._url(t) for t in self.titles}
+        # One request per URL, so titles that only differ in case or spacing
+        # share a single search
+        queries: Dict[str, str] = {}
+        for t, url in urls.items():
+            queries.setdefault(url, t)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pages = executor.map(self.search_titles, queries.values())
+            parsed = dict(zip(queries, pages))
+
         for t in self.titles:
             # Search and check if the title was found
-            print("***")
-            r = self.search(t)
-            r_titles = self.parse_titles(r)
+            r_titles = parsed[urls[t]]
             found, choice, ratio = self.find_title(t, r_titles)
             if r_titles and found:
                 found_titles.append(
                     {"Query": t, "Match": choice, "Score": str(ratio) + "%"}
                 )
-            print("***")
 
-        print("{} titles found out of {}".format(len(found_titles), len(self.titles)))
+        logger.info("%s titles found out of %s", len(found_titles), len(self.titles))
         return found_titles
 
 
 class BookOutletSearch(Scraper):
-    def __init__(self, titles: List[str], fuzz_thresh: int = 90):
-        super().__init__(titles, fuzz_thresh=fuzz_thresh)
+    def __init__(self, titles: List[str], fuzz_thresh: int = 90, workers: int = 8):
+        super().__init__(titles, fuzz_thresh=fuzz_thresh, workers=workers)
         self.base_url = "https://bookoutlet.ca/browse?"
 
-    def parse_titles(self, response: str) -> List[str]:
-        soup = BeautifulSoup(response, "html.parser")
-        titles = set([img["alt"] for img in soup.find_all("img", alt=True)])
-        print("{} titles found".format(len(titles)))
+    def parse_titles(self, response: bytes, encoding: str = "utf-8") -> Dict[str, str]:
+        try:
+            parser = _html_parser(encoding)
+        except LookupError:
+            # Charset libxml2 doesn't know about
+            parser = _html_parser("utf-8")
+        try:
+            tree = html.fromstring(response, parser=parser)
+        except etree.ParserError:
+            # Empty body, e.g. a blocked or failed request
+            logger.debug("0 titles found")
+            return {}
+        # Dedupe on the lowercased title, which is how titles get scored
+        titles = {alt.lower(): str(alt) for alt in _IMG_ALTS(tree)}
+        logger.debug("%s titles found", len(titles))
         return titles
 
-    def _search(self, query: str) -> str:
-        encoded_query = urlencode({"qf": "All", "q": query})
-        url = self.base_url + encoded_query
-        return self.scraper.get(url).text
+    def _url(self, query: str) -> str:
+        # Case and spacing don't change the results, so normalize them out of the URL
+        encoded_query = urlencode({"qf": "All", "q": " ".join(query.lower().split())})
+        return self.base_url + encoded_query
+
+    def _search(self, query: str) -> Tuple[bytes, str]:
+        url = self._url(query)
+        body = bytearray()
+        with self.scraper.get(url, stream=True) as response:
+            # The header charset wins; without one requests assumes ISO-8859-1,
+            # which is wrong for this site, so it is not used
+            content_type = response.headers.get("Content-Type", "").lower()
+            encoding = response.encoding if "charset" in content_type else None
+            chunks = response.iter_content(chunk_size=64 * 1024)
+            for chunk in chunks:
+                body += chunk
+                if len(body) >= _MAX_PAGE_BYTES:
+                    break
+            # A page that ends exactly at the cap isn't cut off
+            if len(body) > _MAX_PAGE_BYTES or next(chunks, b""):
+                logger.warning(
+                    "Search page for '%s' cut off at %s bytes, some results may "
+                    "be missing",
+                    query,
+                    _MAX_PAGE_BYTES,
+                )
+                del body[_MAX_PAGE_BYTES:]
+        if encoding is None:
+            # Then the page's own <meta charset>, then UTF-8
+            meta = _META_CHARSET.search(body, 0, 4096)
+            encoding = meta.group(1).decode("ascii") if meta else "utf-8"
+        return bytes(body), encoding
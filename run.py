@@ -1,23 +1,33 @@
 import argparse
+import logging
+import sys
 
 import pandas as pd
 
 from bookoutlet_goodreads.search.scraper import BookOutletSearch
 
 
-def main(csv_path, output_path, threshold):
-    df = pd.read_csv(csv_path)
-    books = list(df.loc[df["Bookshelves"] == "to-read"]["Title"])
-    print(f"Loaded to-read bookshelve with {len(df)} titles.")
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
 
-    searcher = BookOutletSearch(books, fuzz_thresh=threshold)
+
+def main(csv_path, output_path, threshold, workers):
+    df = pd.read_csv(csv_path, usecols=["Title", "Bookshelves"], dtype=str)
+    to_read = df["Title"][df["Bookshelves"] == "to-read"].dropna()
+    # Titles are used as dict keys during the search, so share one object per title
+    books = [sys.intern(t) for t in to_read]
+    print(f"Loaded to-read bookshelve with {len(books)} titles.")
+
+    searcher = BookOutletSearch(books, fuzz_thresh=threshold, workers=workers)
     results = searcher.search_all_titles()
 
     if results:
         matches = [m["Match"] for m in results]
         with open(output_path, "w") as file:
-            for item in matches:
-                file.write(f"{item}\n")
+            file.write("\n".join(matches) + "\n")
     else:
         matches = []
 
@@ -37,6 +47,16 @@ if __name__ == "__main__":
     parser.add_argument(
         "--threshold", help="Fuzz threshold for searching", type=int, default=100
     )
+    parser.add_argument(
+        "--workers", help="Number of concurrent searches", type=positive_int, default=8
+    )
+    parser.add_argument(
+        "--verbose", help="Log every search and match", action="store_true"
+    )
 
     args = parser.parse_args()
-    main(args.csv, args.output, args.threshold)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.verbose:
+        # Only our own loggers, not urllib3's and cloudscraper's request chatter
+        logging.getLogger("bookoutlet_goodreads").setLevel(logging.DEBUG)
+    main(args.csv, args.output, args.threshold, args.workers)